@@ -7,6 +7,7 @@ SDK for DFS
 import asyncio
 import sys
 from pathlib import Path
+from typing import Optional
 
 import httpx
 
@@ -14,6 +15,36 @@ import httpx
 class StorageClient:
     def __init__(self, base_url: str = "http://localhost:8000"):
         self.base_url = base_url
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def _get_client(self) -> httpx.AsyncClient:
+        """Shared client so consecutive calls reuse keep-alive connections"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                limits=httpx.Limits(max_keepalive_connections=20),
+                timeout=30.0,
+            )
+        return self._client
+
+    async def _check(self, response: httpx.Response, action: str):
+        """Raise for non-200 responses, keeping only the start of the body"""
+        if response.status_code == 200:
+            return
+        # Error bodies (e.g. proxy HTML pages) can be large; read at most 512 bytes
+        detail = b""
+        async for chunk in response.aiter_bytes():
+            detail += chunk
+            if len(detail) >= 512:
+                break
+        detail = detail[:512].decode(errors="replace")
+        raise Exception(f"{action} failed: {response.status_code} - {detail}")
+
+    async def aclose(self):
+        """Close the underlying HTTP connections"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
 
     async def upload_file(self, file_path: str) -> dict:
         """Upload a file to the distributed storage"""
@@ -22,84 +53,59 @@ class StorageClient:
         if not file_path.exists():
             raise FileNotFoundError(f"File not found: {file_path}")
 
-        async with httpx.AsyncClient() as client:
-            with open(file_path, "rb") as f:
-                files = {
-                    "uploaded_file": (file_path.name, f, "application/octet-stream")
-                }
-                response = await client.post(
-                    f"{self.base_url}/files/upload", files=files
-                )
-
-            if response.status_code == 200:
-                return response.json()
-            else:
-                raise Exception(
-                    f"Upload failed: {response.status_code} - {response.text}"
-                )
+        client = await self._get_client()
+        with open(file_path, "rb") as f:
+            files = {"uploaded_file": (file_path.name, f, "application/octet-stream")}
+            response = await client.post("/files/upload", files=files)
+
+        await self._check(response, "Upload")
+        return response.json()
 
     async def download_file(self, file_id: str, output_path: str = None) -> str:
         """Download a file from the distributed storage"""
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{self.base_url}/files/{file_id}")
-
-            if response.status_code == 200:
-                # Determine output filename
-                if output_path is None:
-                    content_disposition = response.headers.get(
-                        "content-disposition", ""
-                    )
-                    if "filename=" in content_disposition:
-                        filename = content_disposition.split("filename=")[1].strip('"')
-                        output_path = f"downloaded_{filename}"
-                    else:
-                        output_path = f"downloaded_{file_id}"
-
-                # Write file content
-                with open(output_path, "wb") as f:
-                    f.write(response.content)
-
-                return output_path
-            else:
-                raise Exception(
-                    f"Download failed: {response.status_code} - {response.text}"
-                )
+        client = await self._get_client()
+        async with client.stream("GET", f"/files/{file_id}") as response:
+            await self._check(response, "Download")
+
+            # Determine output filename
+            if output_path is None:
+                content_disposition = response.headers.get("content-disposition", "")
+                if "filename=" in content_disposition:
+                    filename = content_disposition.split("filename=")[1].strip('"')
+                    output_path = f"downloaded_{filename}"
+                else:
+                    output_path = f"downloaded_{file_id}"
+
+            # Write file content as it arrives instead of buffering it
+            with open(output_path, "wb") as f:
+                async for chunk in response.aiter_bytes(64 * 1024):
+                    f.write(chunk)
+
+            return output_path
 
     async def list_files(self) -> dict:
         """List all files in the storage system"""
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{self.base_url}/files")
+        client = await self._get_client()
+        response = await client.get("/files")
 
-            if response.status_code == 200:
-                return response.json()
-            else:
-                raise Exception(
-                    f"List failed: {response.status_code} - {response.text}"
-                )
+        await self._check(response, "List")
+        return response.json()
 
     async def delete_file(self, file_id: str) -> dict:
         """Delete a file from the storage system"""
-        async with httpx.AsyncClient() as client:
-            response = await client.delete(f"{self.base_url}/files/{file_id}")
+        client = await self._get_client()
+        response = await client.delete(f"/files/{file_id}")
 
-            if response.status_code == 200:
-                return response.json()
-            else:
-                raise Exception(
-                    f"Delete failed: {response.status_code} - {response.text}"
-                )
+        await self._check(response, "Delete")
+        return response.json()
 
     async def get_nodes(self) -> dict:
         """Get information about storage nodes"""
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{self.base_url}/nodes")
+        client = await self._get_client()
+        response = await client.get("/nodes")
 
-            if response.status_code == 200:
-                return response.json()
-            else:
-                raise Exception(
-                    f"Get nodes failed: {response.status_code} - {response.text}"
-                )
+        await self._check(response, "Get nodes")
+        return response.json()
 
 
 async def main():
@@ -191,6 +197,8 @@ async def main():
 
     except Exception as e:
         print(f"Error: {str(e)}")
+    finally:
+        await client.aclose()
 
 
 if __name__ == "__main__":
@@ -1,6 +1,8 @@
 import logging
 from datetime import datetime, timedelta
-from typing import Dict, List
+from typing import List
+
+from sqlalchemy import func
 
 from .database import DatabaseSession, FileLocation, FileMetadata, NodeMetrics
 
@@ -17,6 +19,8 @@ class AnomalyDetector:
         anomalies = []
 
         try:
+            # One session: the detectors share a transaction and stream their
+            # results with yield_per instead of materializing whole tables
             with DatabaseSession() as db:
                 # Detect disk usage dropping to 0
                 anomalies.extend(self._detect_disk_usage_anomalies(db))
@@ -31,43 +35,55 @@ class AnomalyDetector:
                 anomalies.extend(self._detect_file_anomalies(db))
 
         except Exception as e:
-            logger.error(f"Error detecting anomalies: {e}")
+            logger.error("Error detecting anomalies: %s", e)
 
         return anomalies
 
     def _detect_disk_usage_anomalies(self, db) -> List[str]:
         anomalies = []
-        nodes = db.query(NodeMetrics).all()
+        nodes = (
+            db.query(NodeMetrics.node_id)
+            .filter(NodeMetrics.used_storage_bytes == self.disk_usage_threshold)
+            .yield_per(1000)
+        )
 
-        for node in nodes:
-            if node.used_storage_bytes == self.disk_usage_threshold:
-                anomalies.append(f"Node {node.node_id} has disk usage dropping to 0.")
+        for (node_id,) in nodes:
+            anomalies.append(f"Node {node_id} has disk usage dropping to 0.")
 
         return anomalies
 
     def _detect_usage_spikes(self, db) -> List[str]:
         anomalies = []
-        nodes = db.query(NodeMetrics).all()
+        total_ops = (
+            NodeMetrics.upload_ops_count
+            + NodeMetrics.download_ops_count
+            + NodeMetrics.delete_ops_count
+        )
+        nodes = (
+            db.query(NodeMetrics.node_id)
+            .filter(total_ops > self.usage_spike_factor * NodeMetrics.files_count)
+            .yield_per(1000)
+        )
 
-        for node in nodes:
-            if (
-                node.upload_ops_count + node.download_ops_count + node.delete_ops_count
-                > self.usage_spike_factor * node.files_count
-            ):
-                anomalies.append(f"Node {node.node_id} has a sudden spike in usage.")
+        for (node_id,) in nodes:
+            anomalies.append(f"Node {node_id} has a sudden spike in usage.")
 
         return anomalies
 
     def _detect_inactive_nodes(self, db) -> List[str]:
         anomalies = []
         cutoff_time = datetime.utcnow() - timedelta(minutes=self.inactivity_minutes)
+        # A node is inactive when its most recent report is older than the cutoff
         inactive_nodes = (
-            db.query(NodeMetrics).filter(NodeMetrics.timestamp < cutoff_time).all()
+            db.query(NodeMetrics.node_id)
+            .group_by(NodeMetrics.node_id)
+            .having(func.max(NodeMetrics.timestamp) < cutoff_time)
+            .yield_per(1000)
         )
 
-        for node in inactive_nodes:
+        for (node_id,) in inactive_nodes:
             anomalies.append(
-                f"Node {node.node_id} has been inactive for more than {self.inactivity_minutes} minutes."
+                f"Node {node_id} has been inactive for more than {self.inactivity_minutes} minutes."
             )
 
         return anomalies
@@ -76,29 +92,27 @@ class AnomalyDetector:
         anomalies = []
 
         # Detect files in DB but missing on nodes
-        files_in_db = db.query(FileMetadata).all()
-        for file in files_in_db:
-            locations = (
-                db.query(FileLocation)
-                .filter(FileLocation.file_id == file.file_id)
-                .all()
+        files_without_locations = (
+            db.query(FileMetadata.file_id)
+            .outerjoin(FileLocation, FileLocation.file_id == FileMetadata.file_id)
+            .filter(FileLocation.file_id.is_(None))
+            .yield_per(1000)
+        )
+        for (file_id,) in files_without_locations:
+            anomalies.append(
+                f"File {file_id} exists in DB but is missing on all nodes."
             )
-            if not locations:
-                anomalies.append(
-                    f"File {file.file_id} exists in DB but is missing on all nodes."
-                )
 
         # Detect files on nodes but missing in DB
-        files_on_nodes = db.query(FileLocation).all()
-        for file_location in files_on_nodes:
-            file_in_db = (
-                db.query(FileMetadata)
-                .filter(FileMetadata.file_id == file_location.file_id)
-                .first()
+        locations_without_files = (
+            db.query(FileLocation.file_id, FileLocation.node_id)
+            .outerjoin(FileMetadata, FileMetadata.file_id == FileLocation.file_id)
+            .filter(FileMetadata.file_id.is_(None))
+            .yield_per(1000)
+        )
+        for file_id, node_id in locations_without_files:
+            anomalies.append(
+                f"File {file_id} exists on node {node_id} but has no DB entry."
             )
-            if not file_in_db:
-                anomalies.append(
-                    f"File {file_location.file_id} exists on node {file_location.node_id} but has no DB entry."
-                )
 
         return anomalies
@@ -0,0 +1,31 @@
+import time
+from typing import Any, Optional
+
+
+class TTLValue:
+    """A single cached value that expires after ttl seconds"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._value: Any = None
+        self._expires_at = 0.0
+        # Bumped by invalidate() so a load that started earlier can't store
+        # a snapshot from before the write that invalidated it
+        self.generation = 0
+
+    def get(self) -> Optional[Any]:
+        """Return the cached value, or None if it is missing or expired"""
+        if time.monotonic() < self._expires_at:
+            return self._value
+        return None
+
+    def set(self, value: Any, generation: Optional[int] = None):
+        """Cache value, unless it was loaded before the last invalidate()"""
+        if generation is not None and generation != self.generation:
+            return
+        self._value = value
+        self._expires_at = time.monotonic() + self.ttl
+
+    def invalidate(self):
+        self._expires_at = 0.0
+        self.generation += 1
@@ -1,6 +1,7 @@
+import asyncio
+import logging
 import os
 import time
-from datetime import datetime
 
 from sqlalchemy import (
     DDL,
@@ -8,69 +9,134 @@ from sqlalchemy import (
     Boolean,
     Column,
     DateTime,
+    FetchedValue,
     Float,
     ForeignKey,
     Index,
     Integer,
     String,
-    Text,
+    Uuid,
     create_engine,
     event,
+    func,
+    text,
 )
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import NullPool
+
+logger = logging.getLogger(__name__)
 
 DATABASE_URL = os.getenv(
     "DATABASE_URL",
     "postgresql://testuser:testpassword@db:5432/testdb",
 )
 
-engine = create_engine(DATABASE_URL)
+# Pool sizing is per process; keep pool_size + max_overflow below the
+# Postgres max_connections budget divided by the number of workers.
+# Set DB_USE_PGBOUNCER=1 when a PgBouncer sidecar (e.g. on port 6432) owns
+# pooling, so the app opens a cheap connection to it per checkout instead.
+if os.getenv("DB_USE_PGBOUNCER", "0") == "1":
+    engine = create_engine(DATABASE_URL, poolclass=NullPool)
+else:
+    engine = create_engine(
+        DATABASE_URL,
+        pool_size=int(os.getenv("DB_POOL_SIZE", "10")),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "20")),
+        pool_timeout=int(os.getenv("DB_POOL_TIMEOUT", "30")),
+        pool_pre_ping=True,
+        pool_recycle=1800,
+        pool_use_lifo=True,
+    )
+
+# Statements slower than this are logged with their SQL; 0 disables the check
+SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "100"))
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+@event.listens_for(engine, "after_cursor_execute")
+def _log_slow_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed_ms = (time.perf_counter() - conn.info["query_start_time"].pop()) * 1000
+    if SLOW_QUERY_MS and elapsed_ms > SLOW_QUERY_MS:
+        logger.warning("Slow query (%.1f ms): %s", elapsed_ms, statement)
+
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# Timestamps are filled in by Postgres as naive UTC, matching datetime.utcnow()
+# comparisons in the services regardless of the server's TimeZone setting
+utc_now = func.timezone("utc", func.now())
+
 
 class FileMetadata(Base):
     __tablename__ = "files"
 
-    file_id = Column(String, primary_key=True)
+    # Native 16-byte uuid; as_uuid=False keeps the Python side as plain strings
+    file_id = Column(Uuid(as_uuid=False), primary_key=True)
     filename = Column(String, nullable=False)
     size = Column(BigInteger, nullable=False)  # Changed to BIGINT for large files
     checksum = Column(String, nullable=False)
-    created_at = Column(DateTime, default=datetime.utcnow, index=True)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-    is_deleted = Column(Boolean, default=False, index=True)
+    created_at = Column(DateTime, server_default=utc_now, index=True)
+    # Kept current by the update_files_updated_at trigger
+    updated_at = Column(
+        DateTime, server_default=utc_now, server_onupdate=FetchedValue()
+    )
+    is_deleted = Column(Boolean, default=False)
 
 
 class StorageNode(Base):
     __tablename__ = "storage_nodes"
+    # Partial over active nodes only: serves the active-node list, the
+    # stale-heartbeat sweep and freshest-replica ordering
+    __table_args__ = (
+        Index(
+            "ix_storage_nodes_active_heartbeat",
+            "last_heartbeat",
+            postgresql_where=text("is_active"),
+        ),
+    )
 
     node_id = Column(String, primary_key=True)
     url = Column(String, nullable=False)
     capacity = Column(BigInteger, nullable=False)  # BIGINT for large storage
     used_space = Column(BigInteger, default=0)
-    is_active = Column(Boolean, default=True, index=True)
-    last_heartbeat = Column(DateTime, default=datetime.utcnow)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    is_active = Column(Boolean, default=True)
+    last_heartbeat = Column(DateTime, server_default=utc_now)
+    created_at = Column(DateTime, server_default=utc_now)
 
 
 class FileLocation(Base):
     __tablename__ = "file_locations"
+    # Unique so the same file can't be placed twice on one node
+    __table_args__ = (
+        Index("ix_file_locations_file_node", "file_id", "node_id", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    file_id = Column(String, ForeignKey("files.file_id"), nullable=False, index=True)
+    file_id = Column(Uuid(as_uuid=False), ForeignKey("files.file_id"), nullable=False)
     node_id = Column(
         String, ForeignKey("storage_nodes.node_id"), nullable=False, index=True
     )
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, server_default=utc_now)
 
 
 class NodeMetrics(Base):
     __tablename__ = "node_metrics"
+    __table_args__ = (
+        # Per-node time order: latest-per-node (DISTINCT ON) and history pages
+        Index("ix_node_metrics_node_ts", "node_id", "timestamp"),
+        # Range scans by time alone: retention cleanup and recent-window reads
+        Index("ix_node_metrics_ts", "timestamp"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    node_id = Column(String, index=True, nullable=False)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    node_id = Column(String, nullable=False)
+    timestamp = Column(DateTime, server_default=utc_now)
 
     # Storage metrics
     total_storage_bytes = Column(BigInteger, default=0)
@@ -88,7 +154,7 @@ class NodeMetrics(Base):
     is_healthy = Column(Boolean, default=True)
     cpu_usage_percent = Column(Float, default=0.0)
     memory_usage_percent = Column(Float, default=0.0)
-    last_heartbeat = Column(DateTime, default=datetime.utcnow)
+    last_heartbeat = Column(DateTime, server_default=utc_now)
 
 
 # trigger function and trigger for automatic updated_at updates
@@ -97,7 +163,7 @@ update_timestamp_trigger = DDL(
     CREATE OR REPLACE FUNCTION update_updated_at_column()
     RETURNS TRIGGER AS $$
     BEGIN
-        NEW.updated_at = CURRENT_TIMESTAMP;
+        NEW.updated_at = timezone('utc', now());
         RETURN NEW;
     END;
     $$ language 'plpgsql';
@@ -114,26 +180,38 @@ update_timestamp_trigger = DDL(
 event.listen(FileMetadata.__table__, "after_create", update_timestamp_trigger)
 
 
-def init_database():
+async def init_database():
     """Initialize database tables with retry logic"""
-    max_retries = 30
-    retry_interval = 2
-
-    for attempt in range(max_retries):
+    max_wait = 120  # seconds in total before giving up on the database
+    max_retry_interval = 10
+
+    # Deployments with a pre-provisioned schema can skip the metadata sweep
+    if os.getenv("DB_AUTOCREATE", "1") != "1":
+        print("DB_AUTOCREATE disabled, skipping table creation")
+        return
+
+    deadline = time.monotonic() + max_wait
+    attempt = 0
+    while True:
+        attempt += 1
         try:
-            # Try to create tables
-            Base.metadata.create_all(bind=engine)
+            # DDL runs on a worker thread so startup doesn't block the loop
+            await asyncio.to_thread(Base.metadata.create_all, bind=engine)
             print("Database tables created successfully")
             return
         except OperationalError as e:
-            if attempt < max_retries - 1:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
                 print(
-                    f"Database not ready, attempt {attempt + 1}/{max_retries}. Retrying in {retry_interval}s..."
+                    f"Failed to connect to database after {attempt} attempts ({max_wait}s)"
                 )
-                time.sleep(retry_interval)
-            else:
-                print(f"Failed to connect to database after {max_retries} attempts")
                 raise e
+            # Exponential backoff, but never sleep past the overall deadline
+            retry_interval = min(2 ** (attempt - 1), max_retry_interval, remaining)
+            print(
+                f"Database not ready, attempt {attempt}. Retrying in {retry_interval:.0f}s..."
+            )
+            await asyncio.sleep(retry_interval)
 
 
 def get_db_session():
@@ -1,36 +1,90 @@
 import asyncio
-import io
 import logging
+import os
+import queue
 import uuid
 from contextlib import asynccontextmanager
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
 
-from fastapi import FastAPI, File, HTTPException, UploadFile
-from fastapi.responses import StreamingResponse
+import orjson
+from fastapi import FastAPI, File, HTTPException, Query, UploadFile
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 
 from .anomaly_detector import AnomalyDetector
 from .database import init_database
+from .models import HeartbeatRequest, NodeMetricsPayload, NodeRegistration
 from .monitoring import MonitoringService
 from .services import FileService, NodeService
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-file_svc = FileService()
 node_svc = NodeService()
+file_svc = FileService(node_svc)
 monitoring_svc = MonitoringService()
 anomaly_detector = AnomalyDetector()
 
 
+def start_log_listener() -> QueueListener:
+    """Send root log records through a queue so handler I/O runs off the loop"""
+    root_logger = logging.getLogger()
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(
+        log_queue, *root_logger.handlers, respect_handler_level=True
+    )
+    root_logger.handlers = [QueueHandler(log_queue)]
+    listener.start()
+    return listener
+
+
+def stop_log_listener(listener: QueueListener):
+    """Flush queued records and put the original handlers back"""
+    listener.stop()
+    logging.getLogger().handlers = list(listener.handlers)
+
+
+async def periodic_anomaly_detection():
+    """Run anomaly detection periodically every 10 minutes."""
+    while True:
+        try:
+            anomalies = await asyncio.to_thread(anomaly_detector.detect_anomalies)
+            if anomalies:
+                logger.warning("Detected anomalies: %s", anomalies)
+        except Exception as e:
+            logger.error("Error in periodic anomaly detection: %s", e)
+        await asyncio.sleep(600)  # 10 minutes
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    log_listener = start_log_listener()
     logger.info("Starting controller...")
-    init_database()
+    await init_database()
     await node_svc.discover_nodes()
+    metrics_flusher = asyncio.create_task(monitoring_svc.run_metrics_flusher())
+    metrics_retention = asyncio.create_task(monitoring_svc.run_retention())
+    anomaly_task = asyncio.create_task(periodic_anomaly_detection())
     yield
     logger.info("Shutting down controller...")
+    anomaly_task.cancel()
+    metrics_retention.cancel()
+    metrics_flusher.cancel()
+    # Don't lose whatever arrived since the last periodic flush
+    await asyncio.to_thread(monitoring_svc.flush_metrics)
+    await file_svc.aclose()
+    stop_log_listener(log_listener)
 
 
-app = FastAPI(title="Storage Controller", version="1.0.0", lifespan=lifespan)
+# orjson serializes the list endpoints (and datetimes) much faster than json
+app = FastAPI(
+    title="Storage Controller",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 
 @app.get("/health")
@@ -44,23 +98,28 @@ async def get_storage_nodes():
     return {"nodes": active_nodes}
 
 
+async def _read_chunks(uploaded_file: UploadFile, chunk_size: int = 1 << 20):
+    """Yield the upload in fixed-size chunks instead of one big bytes object"""
+    while chunk := await uploaded_file.read(chunk_size):
+        yield chunk
+
+
 @app.post("/files/upload")
 async def upload_file(uploaded_file: UploadFile = File(...)):
     try:
         file_id = str(uuid.uuid4())
-        file_data = await uploaded_file.read()
         storage_results = await file_svc.store_file(
-            file_id, uploaded_file.filename, file_data
+            file_id, uploaded_file.filename, _read_chunks(uploaded_file)
         )
         return {
             "file_id": file_id,
             "filename": uploaded_file.filename,
-            "size": len(file_data),
+            "size": storage_results["size"],
             "nodes": storage_results["nodes"],
             "status": "uploaded",
         }
     except Exception as ex:
-        logger.error(f"Upload failed: {str(ex)}")
+        logger.error("Upload failed: %s", ex)
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(ex)}")
 
 
@@ -70,22 +129,27 @@ async def download_file(file_id: str):
         file_info = await file_svc.retrieve_file(file_id)
         if not file_info:
             raise HTTPException(status_code=404, detail="File not found")
+        # Proxy the node's body chunk by chunk; close it once the client is done
+        node_response = file_info["stream"]
         return StreamingResponse(
-            io.BytesIO(file_info["content"]),
+            node_response.aiter_raw(1 << 20),
             media_type="application/octet-stream",
             headers={
                 "Content-Disposition": f"attachment; filename={file_info['filename']}"
             },
+            background=BackgroundTask(node_response.aclose),
         )
     except Exception as ex:
-        logger.error(f"Download failed: {str(ex)}")
+        logger.error("Download failed: %s", ex)
         raise HTTPException(status_code=500, detail=f"Download failed: {str(ex)}")
 
 
 @app.get("/files")
 async def list_files():
     file_list = await file_svc.list_files()
-    return {"files": file_list}
+    # The listing can be large; encode it on a worker thread, not the loop
+    body = await asyncio.to_thread(orjson.dumps, {"files": file_list})
+    return Response(content=body, media_type="application/json")
 
 
 @app.delete("/files/{file_id}")
@@ -98,15 +162,13 @@ async def delete_file(file_id: str):
             "nodes_cleaned": delete_result["nodes_cleaned"],
         }
     except Exception as ex:
-        logger.error(f"Delete failed: {str(ex)}")
+        logger.error("Delete failed: %s", ex)
         raise HTTPException(status_code=500, detail=f"Delete failed: {str(ex)}")
 
 
 @app.post("/nodes/heartbeat")
-async def node_heartbeat(heartbeat_data: dict):
-    node_id = heartbeat_data.get("node_id")
-    if not node_id:
-        raise HTTPException(status_code=400, detail="node_id required")
+async def node_heartbeat(heartbeat_data: HeartbeatRequest):
+    node_id = heartbeat_data.node_id
     success = await node_svc.update_node_heartbeat(node_id)
     if success:
         return {"status": "ok", "node_id": node_id}
@@ -120,18 +182,18 @@ async def get_nodes_health():
 
 
 @app.post("/nodes/register")
-async def register_node(node_info: dict):
-    node_id = node_info.get("node_id")
-    node_url = node_info.get("url")
-    node_capacity = node_info.get("capacity", 1024 * 1024 * 1024)
-    await node_svc.register_node(node_id, node_url, node_capacity)
-    return {"status": "registered", "node_id": node_id}
+async def register_node(node_info: NodeRegistration):
+    await node_svc.register_node(node_info.node_id, node_info.url, node_info.capacity)
+    return {"status": "registered", "node_id": node_info.node_id}
 
 
+# The monitoring and anomaly services use the synchronous engine, so these
+# endpoints are plain defs and FastAPI runs them in its threadpool instead of
+# blocking the event loop on database I/O
 @app.post("/metrics/nodes/{node_id}")
-async def receive_node_metrics(node_id: str, metrics: dict):
+def receive_node_metrics(node_id: str, metrics: NodeMetricsPayload):
     """Receive metrics from storage nodes"""
-    success = monitoring_svc.record_node_metrics(node_id, metrics)
+    success = monitoring_svc.record_node_metrics(node_id, metrics.model_dump())
     if success:
         return {"status": "recorded", "node_id": node_id}
     else:
@@ -139,35 +201,42 @@ async def receive_node_metrics(node_id: str, metrics: dict):
 
 
 @app.get("/metrics/nodes/{node_id}")
-async def get_node_metrics(node_id: str, hours: int = 24):
-    """Get historical metrics for a specific node"""
-    metrics = monitoring_svc.get_node_metrics_history(node_id, hours)
-    return {"node_id": node_id, "metrics": metrics}
+def get_node_metrics(
+    node_id: str,
+    hours: int = 24,
+    before: Optional[datetime] = None,
+    limit: int = Query(500, ge=1, le=5000),
+):
+    """Get historical metrics for a specific node, newest first, one page at a time"""
+    metrics = monitoring_svc.get_node_metrics_history(node_id, hours, before, limit)
+    # A full page means there may be more; pass next_cursor back as `before`
+    next_cursor = metrics[-1]["timestamp"] if len(metrics) == limit else None
+    return {"node_id": node_id, "metrics": metrics, "next_cursor": next_cursor}
 
 
 @app.get("/metrics/cluster")
-async def get_cluster_metrics():
+def get_cluster_metrics(include_nodes: bool = True):
     """Get cluster-wide metrics overview"""
-    return monitoring_svc.get_cluster_overview()
+    return monitoring_svc.get_cluster_overview(include_nodes)
 
 
 @app.get("/anomalies")
-async def get_anomalies():
+def get_anomalies():
     """Fetch detected anomalies in the system"""
     anomalies = anomaly_detector.detect_anomalies()
     return {"anomalies": anomalies}
 
 
-@app.on_event("startup")
-@repeat_every(seconds=600)  # 10 minutes
-async def periodic_anomaly_detection():
-    """Run anomaly detection periodically every 10 minutes."""
-    anomalies = anomaly_detector.detect_anomalies()
-    if anomalies:
-        logger.warning(f"Detected anomalies: {anomalies}")
-
-
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Background tasks and caches live in-process, so more than one worker
+    # duplicates them; scale out with WEB_CONCURRENCY only when that's acceptable
+    uvicorn.run(
+        "controller.main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+    )
@@ -0,0 +1,36 @@
+from datetime import datetime
+from typing import Optional
+
+from pydantic import BaseModel
+
+
+class NodeRegistration(BaseModel):
+    """Body sent by a storage node when it registers"""
+
+    node_id: str
+    url: str
+    capacity: int = 1024 * 1024 * 1024
+
+
+class HeartbeatRequest(BaseModel):
+    """Body of a storage node heartbeat"""
+
+    node_id: str
+    timestamp: Optional[datetime] = None
+    status: Optional[str] = None
+
+
+class NodeMetricsPayload(BaseModel):
+    """Metrics snapshot reported by a storage node"""
+
+    total_storage_bytes: int = 0
+    used_storage_bytes: int = 0
+    available_storage_bytes: int = 0
+    files_count: int = 0
+    upload_ops_count: int = 0
+    download_ops_count: int = 0
+    delete_ops_count: int = 0
+    avg_response_time_ms: float = 0.0
+    is_healthy: bool = True
+    cpu_usage_percent: float = 0.0
+    memory_usage_percent: float = 0.0
@@ -1,135 +1,394 @@
+import asyncio
+import csv
+import io
 import logging
+import os
+import threading
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional
 
-from .database import DatabaseSession, NodeMetrics
+from sqlalchemy import case, delete, func, select
+
+from .cache import TTLValue
+from .database import DatabaseSession, NodeMetrics, engine
 
 logger = logging.getLogger(__name__)
 
+# Column order shared by the buffered rows and the COPY statement
+_METRICS_COLUMNS = (
+    "node_id",
+    "timestamp",
+    "total_storage_bytes",
+    "used_storage_bytes",
+    "available_storage_bytes",
+    "files_count",
+    "upload_ops_count",
+    "download_ops_count",
+    "delete_ops_count",
+    "avg_response_time_ms",
+    "is_healthy",
+    "cpu_usage_percent",
+    "memory_usage_percent",
+    "last_heartbeat",
+)
+_COPY_METRICS_SQL = (
+    f"COPY node_metrics ({', '.join(_METRICS_COLUMNS)}) FROM STDIN WITH (FORMAT csv)"
+)
+
 
 class MonitoringService:
     def __init__(self):
-        pass
+        # Metrics rows wait here until the background flusher COPYs them in
+        self.metrics_buffer: List[tuple] = []
+        self.buffer_lock = threading.Lock()
+        self.flush_interval = 2  # seconds
+        # Metrics are ephemeral: while the database is unreachable keep at most
+        # this many rows and drop the oldest rather than growing without bound
+        self.max_buffered_rows = int(os.getenv("METRICS_BUFFER_MAX_ROWS", "50000"))
+        self.retention_days = int(os.getenv("METRICS_RETENTION_DAYS", "7"))
+        self.retention_interval = 3600  # seconds
+        self.retention_batch_size = int(
+            os.getenv("METRICS_RETENTION_BATCH_SIZE", "5000")
+        )
+        # Overview polling is served from memory for a few seconds at a time
+        self.overview_cache = {True: TTLValue(ttl=10.0), False: TTLValue(ttl=10.0)}
+        # Write-through view of each node's latest report. Only correct when this
+        # process sees every metrics POST (one controller process, one worker),
+        # so it has to be switched on explicitly
+        self.latest_metrics: Dict[str, Dict] = {}
+        self.latest_metrics_window = 60  # seconds, nodes report every 15
+        self.latest_metrics_loaded = False
+        self.serve_latest_from_memory = (
+            os.getenv("METRICS_OVERVIEW_FROM_MEMORY", "0") == "1"
+        )
 
     def record_node_metrics(self, node_id: str, metrics: Dict) -> bool:
-        """Record metrics for a specific node"""
+        """Queue metrics for a specific node for the next bulk flush"""
         try:
-            with DatabaseSession() as db:
-                node_metrics = NodeMetrics(
-                    node_id=node_id,
-                    total_storage_bytes=metrics.get("total_storage_bytes", 0),
-                    used_storage_bytes=metrics.get("used_storage_bytes", 0),
-                    available_storage_bytes=metrics.get("available_storage_bytes", 0),
-                    files_count=metrics.get("files_count", 0),
-                    upload_ops_count=metrics.get("upload_ops_count", 0),
-                    download_ops_count=metrics.get("download_ops_count", 0),
-                    delete_ops_count=metrics.get("delete_ops_count", 0),
-                    avg_response_time_ms=metrics.get("avg_response_time_ms", 0.0),
-                    is_healthy=metrics.get("is_healthy", True),
-                    cpu_usage_percent=metrics.get("cpu_usage_percent", 0.0),
-                    memory_usage_percent=metrics.get("memory_usage_percent", 0.0),
-                )
-                db.add(node_metrics)
-                db.commit()
-                logger.info(f"Recorded metrics for node {node_id}")
-                return True
+            received_at = datetime.utcnow()
+            row = (
+                node_id,
+                received_at,
+                metrics.get("total_storage_bytes", 0),
+                metrics.get("used_storage_bytes", 0),
+                metrics.get("available_storage_bytes", 0),
+                metrics.get("files_count", 0),
+                metrics.get("upload_ops_count", 0),
+                metrics.get("download_ops_count", 0),
+                metrics.get("delete_ops_count", 0),
+                metrics.get("avg_response_time_ms", 0.0),
+                metrics.get("is_healthy", True),
+                metrics.get("cpu_usage_percent", 0.0),
+                metrics.get("memory_usage_percent", 0.0),
+                received_at,
+            )
+            with self.buffer_lock:
+                self.metrics_buffer.append(row)
+                self._trim_buffer()
+                # Only kept when it is read; it's evicted on the overview path
+                if self.serve_latest_from_memory:
+                    self.latest_metrics[node_id] = {
+                        "timestamp": received_at,
+                        "total_storage_bytes": row[2],
+                        "used_storage_bytes": row[3],
+                        "available_storage_bytes": row[4],
+                        "files_count": row[5],
+                        "is_healthy": row[10],
+                        "total_ops": row[6] + row[7] + row[8],
+                        "avg_response_time_ms": row[9],
+                    }
+            logger.debug("Buffered metrics for node %s", node_id)
+            return True
         except Exception as e:
-            logger.error(f"Failed to record metrics for node {node_id}: {e}")
+            logger.error("Failed to record metrics for node %s: %s", node_id, e)
             return False
 
-    def get_node_metrics_history(self, node_id: str, hours: int = 24) -> List[Dict]:
-        """Get historical metrics for a node"""
+    def flush_metrics(self) -> int:
+        """Write all buffered metrics rows with a single COPY"""
+        with self.buffer_lock:
+            batch, self.metrics_buffer = self.metrics_buffer, []
+        if not batch:
+            return 0
+
+        csv_buffer = io.StringIO()
+        csv.writer(csv_buffer).writerows(batch)
+        csv_buffer.seek(0)
+
+        raw_conn = None
+        try:
+            # Inside the try: an unreachable database fails right here
+            raw_conn = engine.raw_connection()
+            with raw_conn.cursor() as cursor:
+                cursor.copy_expert(_COPY_METRICS_SQL, csv_buffer)
+            raw_conn.commit()
+        except Exception as e:
+            # Put the rows back so they go out with the next flush
+            with self.buffer_lock:
+                self.metrics_buffer[:0] = batch
+                self._trim_buffer()
+            logger.error("Failed to flush %s metrics rows: %s", len(batch), e)
+            if raw_conn is not None:
+                try:
+                    raw_conn.rollback()
+                except Exception as rollback_error:
+                    logger.debug("Rollback after failed flush: %s", rollback_error)
+            return 0
+        finally:
+            if raw_conn is not None:
+                raw_conn.close()
+
+        logger.info("Flushed %s metrics rows", len(batch))
+        return len(batch)
+
+    def _trim_buffer(self):
+        """Drop the oldest buffered rows past the cap; call with buffer_lock held"""
+        overflow = len(self.metrics_buffer) - self.max_buffered_rows
+        if overflow > 0:
+            del self.metrics_buffer[:overflow]
+            logger.warning("Metrics buffer full, dropped %s oldest rows", overflow)
+
+    async def run_metrics_flusher(self):
+        """Background task that periodically flushes buffered metrics"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await asyncio.to_thread(self.flush_metrics)
+            except Exception as e:
+                logger.error("Error in metrics flusher: %s", e)
+
+    def cleanup_old_metrics(self) -> int:
+        """Delete metrics older than the retention window"""
+        cutoff_time = datetime.utcnow() - timedelta(days=self.retention_days)
+        # Bounded batches, each in its own short transaction, so the purge never
+        # holds long locks or one huge chunk of WAL against the metrics writers
+        expired_ids = (
+            select(NodeMetrics.id)
+            .where(NodeMetrics.timestamp < cutoff_time)
+            .limit(self.retention_batch_size)
+        )
+        # No ORM objects to synchronize; without this the IN-subquery makes
+        # SQLAlchemy fall back to fetching every deleted id via RETURNING
+        stmt = (
+            delete(NodeMetrics)
+            .where(NodeMetrics.id.in_(expired_ids))
+            .execution_options(synchronize_session=False)
+        )
+        total_removed = 0
+        with DatabaseSession() as db:
+            try:
+                while True:
+                    removed = db.execute(stmt).rowcount
+                    db.commit()
+                    total_removed += removed
+                    if removed < self.retention_batch_size:
+                        break
+            except Exception as e:
+                db.rollback()
+                logger.error("Failed to clean up old metrics: %s", e)
+        logger.info("Removed %s metrics rows before %s", total_removed, cutoff_time)
+        return total_removed
+
+    async def run_retention(self):
+        """Background task that keeps node_metrics within the retention window"""
+        while True:
+            try:
+                await asyncio.to_thread(self.cleanup_old_metrics)
+            except Exception as e:
+                logger.error("Error in metrics retention: %s", e)
+            await asyncio.sleep(self.retention_interval)
+
+    def get_node_metrics_history(
+        self,
+        node_id: str,
+        hours: int = 24,
+        before: Optional[datetime] = None,
+        limit: int = 500,
+    ) -> List[Dict]:
+        """Get one page of historical metrics for a node, newest first"""
         try:
             with DatabaseSession() as db:
                 since = datetime.utcnow() - timedelta(hours=hours)
-                metrics = (
-                    db.query(NodeMetrics)
-                    .filter(
+                stmt = (
+                    select(
+                        NodeMetrics.timestamp,
+                        NodeMetrics.total_storage_bytes,
+                        NodeMetrics.used_storage_bytes,
+                        NodeMetrics.available_storage_bytes,
+                        NodeMetrics.files_count,
+                        NodeMetrics.upload_ops_count,
+                        NodeMetrics.download_ops_count,
+                        NodeMetrics.delete_ops_count,
+                        NodeMetrics.avg_response_time_ms,
+                        NodeMetrics.is_healthy,
+                        NodeMetrics.cpu_usage_percent,
+                        NodeMetrics.memory_usage_percent,
+                    )
+                    .where(
                         NodeMetrics.node_id == node_id, NodeMetrics.timestamp >= since
                     )
                     .order_by(NodeMetrics.timestamp.desc())
-                    .all()
+                    .limit(limit)
                 )
+                # Keyset pagination: seek below the previous page's last
+                # timestamp on the (node_id, timestamp) index, no OFFSET scan
+                if before is not None:
+                    stmt = stmt.where(NodeMetrics.timestamp < before)
 
-                return [
-                    {
-                        "timestamp": m.timestamp.isoformat(),
-                        "total_storage_bytes": m.total_storage_bytes,
-                        "used_storage_bytes": m.used_storage_bytes,
-                        "available_storage_bytes": m.available_storage_bytes,
-                        "files_count": m.files_count,
-                        "upload_ops_count": m.upload_ops_count,
-                        "download_ops_count": m.download_ops_count,
-                        "delete_ops_count": m.delete_ops_count,
-                        "avg_response_time_ms": m.avg_response_time_ms,
-                        "is_healthy": m.is_healthy,
-                        "cpu_usage_percent": m.cpu_usage_percent,
-                        "memory_usage_percent": m.memory_usage_percent,
-                    }
-                    for m in metrics
-                ]
+                # Plain row mappings; the column labels are already the API keys
+                return [dict(row) for row in db.execute(stmt).mappings()]
         except Exception as e:
-            logger.error(f"Failed to get metrics history for node {node_id}: {e}")
+            logger.error("Failed to get metrics history for node %s: %s", node_id, e)
             return []
 
-    def get_cluster_overview(self) -> Dict:
+    def get_cluster_overview(self, include_nodes: bool = True) -> Dict:
         """Get cluster-wide metrics overview"""
-        try:
-            with DatabaseSession() as db:
-                # Get latest metrics for each node
-                latest_metrics = {}
-                nodes = db.query(NodeMetrics.node_id).distinct().all()
-
-                for (node_id,) in nodes:
-                    latest = (
-                        db.query(NodeMetrics)
-                        .filter(NodeMetrics.node_id == node_id)
-                        .order_by(NodeMetrics.timestamp.desc())
-                        .first()
-                    )
+        overview_cache = self.overview_cache[include_nodes]
+        cached_overview = overview_cache.get()
+        if cached_overview is not None:
+            return cached_overview
 
-                    if latest:
-                        latest_metrics[node_id] = {
-                            "timestamp": latest.timestamp.isoformat(),
-                            "total_storage_bytes": latest.total_storage_bytes,
-                            "used_storage_bytes": latest.used_storage_bytes,
-                            "available_storage_bytes": latest.available_storage_bytes,
-                            "files_count": latest.files_count,
-                            "is_healthy": latest.is_healthy,
-                            "total_ops": latest.upload_ops_count
-                            + latest.download_ops_count
-                            + latest.delete_ops_count,
-                            "avg_response_time_ms": latest.avg_response_time_ms,
-                        }
-
-                # Calculate cluster totals
-                total_storage = sum(
-                    m["total_storage_bytes"] for m in latest_metrics.values()
-                )
-                total_used = sum(
-                    m["used_storage_bytes"] for m in latest_metrics.values()
-                )
-                total_files = sum(m["files_count"] for m in latest_metrics.values())
-                healthy_nodes = sum(
-                    1 for m in latest_metrics.values() if m["is_healthy"]
+        try:
+            if self.serve_latest_from_memory:
+                overview = self._overview_from_latest(
+                    self._fresh_latest_metrics(), include_nodes
                 )
+            else:
+                overview = self._build_cluster_overview(include_nodes)
+        except Exception as e:
+            logger.error("Failed to get cluster overview: %s", e)
+            return {"cluster_summary": {}, "nodes": {}}
+        overview_cache.set(overview)
+        return overview
+
+    def _fresh_latest_metrics(self) -> Dict[str, Dict]:
+        """Snapshot the in-memory latest metrics, dropping nodes gone quiet"""
+        if not self.latest_metrics_loaded:
+            # Seed from the table once so nodes that reported before this
+            # process started are not missing until their next report
+            loaded = self._load_latest_metrics()
+            with self.buffer_lock:
+                for node_id, latest in loaded.items():
+                    self.latest_metrics.setdefault(node_id, latest)
+            self.latest_metrics_loaded = True
+
+        cutoff = datetime.utcnow() - timedelta(seconds=self.latest_metrics_window)
+        with self.buffer_lock:
+            for node_id in [
+                node_id
+                for node_id, latest in self.latest_metrics.items()
+                if latest["timestamp"] < cutoff
+            ]:
+                del self.latest_metrics[node_id]
+            return dict(self.latest_metrics)
+
+    def _load_latest_metrics(self) -> Dict[str, Dict]:
+        """Latest stored metrics row per node, keyed by node id"""
+        with DatabaseSession() as db:
+            return self._latest_metrics_by_node(self._latest_query(db))
 
+    def _latest_query(self, db):
+        """Latest row per node in one query: DISTINCT ON (node_id)"""
+        # Same window as the in-memory map, so a node that stopped reporting
+        # drops out of the overview whichever path serves it
+        cutoff = datetime.utcnow() - timedelta(seconds=self.latest_metrics_window)
+        # Only the columns the overview reports, not whole NodeMetrics objects
+        return (
+            db.query(
+                NodeMetrics.node_id,
+                NodeMetrics.timestamp,
+                NodeMetrics.total_storage_bytes,
+                NodeMetrics.used_storage_bytes,
+                NodeMetrics.available_storage_bytes,
+                NodeMetrics.files_count,
+                NodeMetrics.is_healthy,
+                NodeMetrics.upload_ops_count,
+                NodeMetrics.download_ops_count,
+                NodeMetrics.delete_ops_count,
+                NodeMetrics.avg_response_time_ms,
+            )
+            .filter(NodeMetrics.timestamp >= cutoff)
+            .distinct(NodeMetrics.node_id)
+            .order_by(NodeMetrics.node_id, NodeMetrics.timestamp.desc())
+        )
+
+    def _latest_metrics_by_node(self, latest_query) -> Dict[str, Dict]:
+        """Shape the latest-row query results as the per-node overview entries"""
+        latest_metrics = {}
+        for latest in latest_query.all():
+            latest_metrics[latest.node_id] = {
+                "timestamp": latest.timestamp,
+                "total_storage_bytes": latest.total_storage_bytes,
+                "used_storage_bytes": latest.used_storage_bytes,
+                "available_storage_bytes": latest.available_storage_bytes,
+                "files_count": latest.files_count,
+                "is_healthy": latest.is_healthy,
+                "total_ops": latest.upload_ops_count
+                + latest.download_ops_count
+                + latest.delete_ops_count,
+                "avg_response_time_ms": latest.avg_response_time_ms,
+            }
+        return latest_metrics
+
+    def _build_cluster_overview(self, include_nodes: bool) -> Dict:
+        """Query the latest metrics per node and total them"""
+        with DatabaseSession() as db:
+            latest_query = self._latest_query(db)
+
+            if not include_nodes:
+                # Only the totals are needed, so let Postgres aggregate them
+                latest = latest_query.subquery("latest")
+                summary_row = db.query(
+                    func.count(),
+                    func.coalesce(func.sum(case((latest.c.is_healthy, 1), else_=0)), 0),
+                    func.coalesce(func.sum(latest.c.total_storage_bytes), 0),
+                    func.coalesce(func.sum(latest.c.used_storage_bytes), 0),
+                    func.coalesce(func.sum(latest.c.files_count), 0),
+                ).one()
+                # SUM(bigint) comes back as numeric/Decimal; the API reports ints
                 return {
-                    "cluster_summary": {
-                        "total_nodes": len(latest_metrics),
-                        "healthy_nodes": healthy_nodes,
-                        "total_storage_bytes": total_storage,
-                        "total_used_bytes": total_used,
-                        "total_available_bytes": total_storage - total_used,
-                        "total_files": total_files,
-                        "storage_utilization_percent": (
-                            (total_used / total_storage * 100)
-                            if total_storage > 0
-                            else 0
-                        ),
-                    },
-                    "nodes": latest_metrics,
+                    "cluster_summary": self._cluster_summary(
+                        *(int(value) for value in summary_row)
+                    )
                 }
-        except Exception as e:
-            logger.error(f"Failed to get cluster overview: {e}")
-            return {"cluster_summary": {}, "nodes": {}}
+
+            return self._overview_from_latest(
+                self._latest_metrics_by_node(latest_query), include_nodes
+            )
+
+    def _overview_from_latest(
+        self, latest_metrics: Dict[str, Dict], include_nodes: bool
+    ) -> Dict:
+        """Total the per-node latest metrics into the overview payload"""
+        overview = {
+            "cluster_summary": self._cluster_summary(
+                len(latest_metrics),
+                sum(1 for m in latest_metrics.values() if m["is_healthy"]),
+                sum(m["total_storage_bytes"] for m in latest_metrics.values()),
+                sum(m["used_storage_bytes"] for m in latest_metrics.values()),
+                sum(m["files_count"] for m in latest_metrics.values()),
+            )
+        }
+        if include_nodes:
+            overview["nodes"] = latest_metrics
+        return overview
+
+    def _cluster_summary(
+        self,
+        total_nodes: int,
+        healthy_nodes: int,
+        total_storage: int,
+        total_used: int,
+        total_files: int,
+    ) -> Dict:
+        """Shape the cluster totals returned by get_cluster_overview"""
+        return {
+            "total_nodes": total_nodes,
+            "healthy_nodes": healthy_nodes,
+            "total_storage_bytes": total_storage,
+            "total_used_bytes": total_used,
+            "total_available_bytes": total_storage - total_used,
+            "total_files": total_files,
+            "storage_utilization_percent": (
+                (total_used / total_storage * 100) if total_storage > 0 else 0
+            ),
+        }
@@ -3,29 +3,53 @@ import hashlib
 import logging
 import os
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from typing import AsyncIterator, Dict, List, Optional
 
 import httpx
-from sqlalchemy.orm import Session
+from sqlalchemy import bindparam, func, insert, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
-from .database import FileLocation, FileMetadata, StorageNode, get_db_session
+from .cache import TTLValue
+from .database import DatabaseSession, FileLocation, FileMetadata, StorageNode
 
 logger = logging.getLogger(__name__)
 
+# Built once at import so the per-heartbeat call reuses the cached compiled SQL
+_HEARTBEAT_STMT = (
+    update(StorageNode)
+    .where(StorageNode.node_id == bindparam("b_node_id"))
+    .values(last_heartbeat=bindparam("heartbeat_at"), is_active=True)
+    .execution_options(synchronize_session=False)
+)
+
 
 class FileService:
-    def __init__(self):
+    def __init__(self, node_svc: "NodeService"):
         # How many copies of each file should we keep?
         self.num_replicas = 2
-
-    async def store_file(self, file_id: str, filename: str, content: bytes) -> Dict:
-        """Take a file and spread it across our storage nodes"""
-        file_hash = hashlib.sha256(content).hexdigest()
-        content_size = len(content)
-
+        self.node_svc = node_svc
+        # Listing can be a few seconds stale; store/delete invalidate it
+        self.file_list_cache = TTLValue(ttl=30.0)
+        # One pooled client for all node traffic so connections are reused
+        self.http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(30.0, connect=2.0),
+            limits=httpx.Limits(
+                max_connections=200,
+                max_keepalive_connections=100,
+                keepalive_expiry=30,
+            ),
+        )
+
+    async def aclose(self):
+        """Close the pooled node connections"""
+        await self.http_client.aclose()
+
+    async def store_file(
+        self, file_id: str, filename: str, chunks: AsyncIterator[bytes]
+    ) -> Dict:
+        """Take a file and spread it across our storage nodes as it streams in"""
         # Find nodes that are currently active
-        node_svc = NodeService()
-        nodes_available = await node_svc.get_active_nodes()
+        nodes_available = await self.node_svc.get_active_nodes()
 
         if len(nodes_available) < self.num_replicas:
             raise Exception(
@@ -35,114 +59,148 @@ class FileService:
         # Pick some nodes to store the file on
         target_nodes = nodes_available[: self.num_replicas]
 
-        # Try to store the file on each selected node
+        # One reader feeds a small bounded queue per replica, so memory stays
+        # at a few chunks no matter how large the upload is
+        queues = [asyncio.Queue(maxsize=4) for _ in target_nodes]
+        uploads = [
+            asyncio.create_task(
+                self._replicate_to_node(node_info["url"], file_id, queue)
+            )
+            for node_info, queue in zip(target_nodes, queues)
+        ]
+
+        # Checksum and size are computed in the same pass as the fan-out
+        file_hash = hashlib.sha256(usedforsecurity=False)
+        content_size = 0
+        try:
+            async for chunk in chunks:
+                # hashlib drops the GIL on large buffers, so hash off the loop
+                await asyncio.to_thread(file_hash.update, chunk)
+                content_size += len(chunk)
+                for queue in queues:
+                    await queue.put(chunk)
+            for queue in queues:
+                await queue.put(None)
+        except BaseException:
+            # Never let a replica commit a truncated upload
+            for upload in uploads:
+                upload.cancel()
+            raise
+
+        results = await asyncio.gather(*uploads, return_exceptions=True)
+        file_hash = file_hash.hexdigest()
+
         successful_stores = []
-        for node_info in target_nodes:
-            try:
-                store_worked = await self._store_file_on_node(
-                    node_info["url"], file_id, content
-                )
-                if store_worked:
-                    successful_stores.append(node_info["node_id"])
-            except Exception as ex:
+        for node_info, store_worked in zip(target_nodes, results):
+            if isinstance(store_worked, Exception):
                 logger.error(
-                    f"Couldn't store on node {node_info['node_id']}: {str(ex)}"
+                    "Couldn't store on node %s: %s", node_info["node_id"], store_worked
                 )
+            elif store_worked:
+                successful_stores.append(node_info["node_id"])
 
         if not successful_stores:
             raise Exception("Couldn't store file anywhere!")
 
         # Record what we did in the database
-        db_session = next(get_db_session())
-        try:
-            # Save the file metadata first
-            file_record = FileMetadata(
-                file_id=file_id,
-                filename=filename,
-                size=content_size,
-                checksum=file_hash,
-            )
-            db_session.add(file_record)
-            db_session.flush()  # Ensure file metadata is committed before adding locations
+        with DatabaseSession() as db_session:
+            try:
+                # Core inserts in one transaction: the metadata row goes in first
+                # so the location rows' foreign key is satisfied, no ORM flush
+                db_session.execute(
+                    insert(FileMetadata).values(
+                        file_id=file_id,
+                        filename=filename,
+                        size=content_size,
+                        checksum=file_hash,
+                    )
+                )
 
-            # Record where we stored it
-            for node_id in successful_stores:
-                location_record = FileLocation(file_id=file_id, node_id=node_id)
-                db_session.add(location_record)
+                # Record where we stored it: one multi-row INSERT for all replicas
+                db_session.execute(
+                    insert(FileLocation),
+                    [
+                        {"file_id": file_id, "node_id": node_id}
+                        for node_id in successful_stores
+                    ],
+                )
 
-            db_session.commit()
-        except Exception as e:
-            db_session.rollback()
-            logger.error(f"Database error during file storage: {str(e)}")
-            raise
-        finally:
-            db_session.close()
+                db_session.commit()
+                self.file_list_cache.invalidate()
+            except Exception as e:
+                db_session.rollback()
+                logger.error("Database error during file storage: %s", e)
+                raise
 
-        return {"nodes": successful_stores, "checksum": file_hash}
+        return {"nodes": successful_stores, "checksum": file_hash, "size": content_size}
 
     async def retrieve_file(self, file_id: str) -> Optional[Dict]:
         """Get a file back from storage"""
-        db_session = next(get_db_session())
-        try:
-            # Look up the file info
-            file_info = (
-                db_session.query(FileMetadata)
+        with DatabaseSession() as db_session:
+            # File info plus every active replica's node in one round trip
+            replicas = (
+                db_session.query(
+                    FileMetadata.filename,
+                    FileMetadata.size,
+                    FileMetadata.checksum,
+                    StorageNode.node_id,
+                    StorageNode.url,
+                )
+                .join(FileLocation, FileLocation.file_id == FileMetadata.file_id)
+                .join(
+                    StorageNode,
+                    (StorageNode.node_id == FileLocation.node_id)
+                    & (StorageNode.is_active == True),
+                )
                 .filter(
                     FileMetadata.file_id == file_id, FileMetadata.is_deleted == False
                 )
-                .first()
-            )
-
-            if not file_info:
-                return None
-
-            # Find out where it's stored
-            storage_locations = (
-                db_session.query(FileLocation)
-                .filter(FileLocation.file_id == file_id)
+                # Most recently heard-from node first, so one GET usually does it
+                .order_by(StorageNode.last_heartbeat.desc())
                 .all()
             )
 
-            if not storage_locations:
-                return None
-
-            # Try each location until we get the file
-            for location in storage_locations:
-                try:
-                    storage_node = (
-                        db_session.query(StorageNode)
-                        .filter(
-                            StorageNode.node_id == location.node_id,
-                            StorageNode.is_active == True,
-                        )
-                        .first()
-                    )
+        for replica in replicas:
+            try:
+                node_response = await self._retrieve_file_from_node(
+                    replica.url, file_id
+                )
+            except httpx.RequestError as e:
+                logger.error(
+                    "Failed to retrieve file from node %s: %s", replica.node_id, e
+                )
+                continue
+
+            if node_response.status_code == 200:
+                # Caller streams the body and must close the response
+                return {
+                    "filename": replica.filename,
+                    "stream": node_response,
+                    "size": replica.size,
+                    "checksum": replica.checksum,
+                }
 
-                    if storage_node:
-                        content = await self._retrieve_file_from_node(
-                            storage_node.url, file_id
-                        )
-                        if content:
-                            return {
-                                "filename": file_info.filename,
-                                "content": content,
-                                "size": file_info.size,
-                                "checksum": file_info.checksum,
-                            }
-                except Exception as e:
-                    logger.error(
-                        f"Failed to retrieve file from node {location.node_id}: {str(e)}"
-                    )
-                    continue
+            await node_response.aclose()
+            if node_response.status_code == 404:
+                # The metadata says the file exists, so this replica lost its copy
+                logger.warning(
+                    "Node %s is missing file %s, trying next replica",
+                    replica.node_id,
+                    file_id,
+                )
+            else:
+                logger.error(
+                    "Node %s failed with %s serving file %s, trying next replica",
+                    replica.node_id,
+                    node_response.status_code,
+                    file_id,
+                )
 
-            return None
-        finally:
-            db_session.close()
+        return None
 
     async def delete_file(self, file_id: str) -> Dict:
         """Delete file from all storage nodes"""
-        db = next(get_db_session())
-        try:
+        with DatabaseSession() as db:
             # Mark file as deleted in metadata
             file_metadata = (
                 db.query(FileMetadata).filter(FileMetadata.file_id == file_id).first()
@@ -153,223 +211,263 @@ class FileService:
 
             file_metadata.is_deleted = True
 
-            # Get file locations
-            file_locations = (
-                db.query(FileLocation).filter(FileLocation.file_id == file_id).all()
+            # Resolve every active node holding the file in one query
+            node_rows = (
+                db.query(FileLocation.node_id, StorageNode.url)
+                .join(StorageNode, StorageNode.node_id == FileLocation.node_id)
+                .filter(
+                    FileLocation.file_id == file_id,
+                    StorageNode.is_active == True,
+                )
+                .all()
             )
 
-            # Delete from nodes
+            # Delete from all nodes at once rather than one after another
+            results = await asyncio.gather(
+                *(
+                    self._delete_file_from_node(node_url, file_id)
+                    for _, node_url in node_rows
+                ),
+                return_exceptions=True,
+            )
             deleted_nodes = []
-            for location in file_locations:
-                try:
-                    node = (
-                        db.query(StorageNode)
-                        .filter(
-                            StorageNode.node_id == location.node_id,
-                            StorageNode.is_active == True,
-                        )
-                        .first()
-                    )
-
-                    if node:
-                        success = await self._delete_file_from_node(node.url, file_id)
-                        if success:
-                            deleted_nodes.append(location.node_id)
-                except Exception as e:
+            for (node_id, _), success in zip(node_rows, results):
+                if isinstance(success, Exception):
                     logger.error(
-                        f"Failed to delete file from node {location.node_id}: {str(e)}"
+                        "Failed to delete file from node %s: %s", node_id, success
                     )
+                elif success:
+                    deleted_nodes.append(node_id)
 
             db.commit()
+            self.file_list_cache.invalidate()
             return {"nodes_cleaned": deleted_nodes}
-        finally:
-            db.close()
 
     async def list_files(self) -> List[Dict]:
         """List all files in the storage system"""
-        db = next(get_db_session())
+        cached_files = self.file_list_cache.get()
+        if cached_files is not None:
+            return cached_files
+
+        # The query and row building are blocking, so keep them off the loop.
+        # A write may invalidate the cache meanwhile; then don't cache this load
+        generation = self.file_list_cache.generation
+        file_list = await asyncio.to_thread(self._load_file_list)
+        self.file_list_cache.set(file_list, generation)
+        return file_list
+
+    def _load_file_list(self) -> List[Dict]:
+        """Read every non-deleted file's listing fields from the database"""
+        with DatabaseSession() as db:
+            # Only the returned columns, streamed in batches instead of full entities
+            stmt = (
+                select(
+                    FileMetadata.file_id,
+                    FileMetadata.filename,
+                    FileMetadata.size,
+                    FileMetadata.created_at,
+                    FileMetadata.checksum,
+                )
+                .where(FileMetadata.is_deleted == False)
+                .execution_options(yield_per=1000)
+            )
+
+            return [dict(row) for row in db.execute(stmt).mappings()]
+
+    async def _replicate_to_node(
+        self, node_url: str, file_id: str, queue: asyncio.Queue
+    ) -> bool:
+        """Stream the chunks queued by store_file to one storage node"""
+        finished = False
+
+        async def queued_chunks():
+            nonlocal finished
+            while (chunk := await queue.get()) is not None:
+                yield chunk
+            finished = True
+
         try:
-            files = (
-                db.query(FileMetadata).filter(FileMetadata.is_deleted == False).all()
+            store_worked = await self._store_file_on_node(
+                node_url, file_id, queued_chunks()
             )
+        except Exception as e:
+            # Whatever escapes counts as a failed replica, never a dead task the
+            # reader would block on. Cancellation still propagates: then the
+            # reader has stopped and there is nothing left to drain
+            logger.error("Error storing file %s on %s: %s", file_id, node_url, e)
+            store_worked = False
 
-            return [
-                {
-                    "file_id": f.file_id,
-                    "filename": f.filename,
-                    "size": f.size,
-                    "created_at": f.created_at.isoformat(),
-                    "checksum": f.checksum,
-                }
-                for f in files
-            ]
-        finally:
-            db.close()
+        # If the node failed mid-stream keep draining so the reader never blocks
+        while not finished:
+            finished = await queue.get() is None
+        return store_worked
 
     async def _store_file_on_node(
-        self, node_url: str, file_id: str, content: bytes
+        self, node_url: str, file_id: str, content: AsyncIterator[bytes]
     ) -> bool:
         """Store file on a specific storage node"""
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.post(
-                    f"{node_url}/store/{file_id}",
-                    content=content,
-                    headers={"Content-Type": "application/octet-stream"},
-                    timeout=30.0,
-                )
-                return response.status_code == 200
-            except Exception as e:
-                logger.error(f"Error storing file on node {node_url}: {str(e)}")
-                return False
+        try:
+            # An async iterator body is sent with chunked transfer encoding
+            response = await self.http_client.post(
+                f"{node_url}/store/{file_id}",
+                content=content,
+                headers={"Content-Type": "application/octet-stream"},
+            )
+            return response.status_code == 200
+        except Exception as e:
+            logger.error("Error storing file on node %s: %s", node_url, e)
+            return False
 
     async def _retrieve_file_from_node(
         self, node_url: str, file_id: str
-    ) -> Optional[bytes]:
-        """Retrieve file from a specific storage node"""
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.get(
-                    f"{node_url}/retrieve/{file_id}", timeout=30.0
-                )
-                if response.status_code == 200:
-                    return response.content
-                return None
-            except Exception as e:
-                logger.error(f"Error retrieving file from node {node_url}: {str(e)}")
-                return None
+    ) -> httpx.Response:
+        """Open a streamed download from a specific storage node"""
+        request = self.http_client.build_request(
+            "GET", f"{node_url}/retrieve/{file_id}"
+        )
+        return await self.http_client.send(request, stream=True)
 
     async def _delete_file_from_node(self, node_url: str, file_id: str) -> bool:
         """Delete file from a specific storage node"""
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.delete(
-                    f"{node_url}/delete/{file_id}", timeout=30.0
-                )
-                return response.status_code == 200
-            except Exception as e:
-                logger.error(f"Error deleting file from node {node_url}: {str(e)}")
-                return False
+        try:
+            response = await self.http_client.delete(f"{node_url}/delete/{file_id}")
+            return response.status_code == 200
+        except Exception as e:
+            logger.error("Error deleting file from node %s: %s", node_url, e)
+            return False
 
 
 class NodeService:
     def __init__(self):
         self.min_required_nodes = int(os.getenv("MIN_REQUIRED_NODES", "2"))
         self.heartbeat_timeout = 30  # seconds
+        # The active set changes on a seconds scale, so uploads can share it
+        self.active_nodes_cache = TTLValue(ttl=1.0)
 
     async def get_active_nodes(self) -> List[Dict]:
         """Get list of active storage nodes"""
-        db = next(get_db_session())
-        try:
-            nodes = db.query(StorageNode).filter(StorageNode.is_active == True).all()
-
-            return [
-                {
-                    "node_id": node.node_id,
-                    "url": node.url,
-                    "capacity": node.capacity,
-                    "used_space": node.used_space,
-                    "last_heartbeat": node.last_heartbeat.isoformat(),
-                }
-                for node in nodes
-            ]
-        finally:
-            db.close()
+        cached_nodes = self.active_nodes_cache.get()
+        if cached_nodes is not None:
+            return cached_nodes
+
+        with DatabaseSession() as db:
+            stmt = select(
+                StorageNode.node_id,
+                StorageNode.url,
+                StorageNode.capacity,
+                StorageNode.used_space,
+                StorageNode.last_heartbeat,
+            ).where(StorageNode.is_active == True)
+
+            # Datetimes are left as-is; ORJSONResponse encodes them natively
+            active_nodes = [dict(row) for row in db.execute(stmt).mappings()]
+        self.active_nodes_cache.set(active_nodes)
+        return active_nodes
 
     async def register_node(self, node_id: str, url: str, capacity: int) -> bool:
         """Register a new storage node"""
-        db = next(get_db_session())
-        try:
-            # Check if node already exists
-            existing_node = (
-                db.query(StorageNode).filter(StorageNode.node_id == node_id).first()
-            )
-
-            if existing_node:
-                # Update existing node
-                existing_node.url = url
-                existing_node.capacity = capacity
-                existing_node.is_active = True
-                existing_node.last_heartbeat = datetime.utcnow()
-                logger.info(f"Node {node_id} re-registered")
-            else:
-                # Create new node
-                new_node = StorageNode(
-                    node_id=node_id, url=url, capacity=capacity, is_active=True
+        with DatabaseSession() as db:
+            try:
+                # One atomic upsert: a re-registering node just gets its row
+                # refreshed, with no SELECT-then-write race between replicas
+                stmt = pg_insert(StorageNode).values(
+                    node_id=node_id,
+                    url=url,
+                    capacity=capacity,
+                    is_active=True,
+                    last_heartbeat=datetime.utcnow(),
                 )
-                db.add(new_node)
-                logger.info(f"New node {node_id} registered")
-
-            db.commit()
-            return True
-        except Exception as e:
-            logger.error(f"Error registering node {node_id}: {str(e)}")
-            db.rollback()
-            return False
-        finally:
-            db.close()
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[StorageNode.node_id],
+                    set_={
+                        "url": stmt.excluded.url,
+                        "capacity": stmt.excluded.capacity,
+                        "is_active": True,
+                        "last_heartbeat": stmt.excluded.last_heartbeat,
+                    },
+                )
+                db.execute(stmt)
+                db.commit()
+                logger.info("Node %s registered", node_id)
+                self.active_nodes_cache.invalidate()
+                return True
+            except Exception as e:
+                logger.error("Error registering node %s: %s", node_id, e)
+                db.rollback()
+                return False
 
     async def check_node_health(self) -> Dict:
         """Check health of all registered nodes and manage replacements"""
-        db = next(get_db_session())
-        try:
-            cutoff_time = datetime.utcnow() - timedelta(seconds=self.heartbeat_timeout)
-
-            # Find nodes that haven't sent heartbeat recently
-            stale_nodes = (
-                db.query(StorageNode)
-                .filter(
-                    StorageNode.is_active == True,
-                    StorageNode.last_heartbeat < cutoff_time,
+        with DatabaseSession() as db:
+            try:
+                cutoff_time = datetime.utcnow() - timedelta(
+                    seconds=self.heartbeat_timeout
                 )
-                .all()
-            )
 
-            # Mark stale nodes as inactive
-            for node in stale_nodes:
-                logger.warning(
-                    f"Node {node.node_id} marked as inactive due to missed heartbeat"
+                # Deactivate nodes that haven't sent a heartbeat recently in one
+                # UPDATE, getting their ids back for the log and the response
+                stale_node_ids = list(
+                    db.scalars(
+                        update(StorageNode)
+                        .where(
+                            StorageNode.is_active == True,
+                            StorageNode.last_heartbeat < cutoff_time,
+                        )
+                        .values(is_active=False)
+                        .returning(StorageNode.node_id)
+                        .execution_options(synchronize_session=False)
+                    )
                 )
-                node.is_active = False
-
-            # Count active nodes
-            active_node_count = (
-                db.query(StorageNode).filter(StorageNode.is_active == True).count()
-            )
+                for node_id in stale_node_ids:
+                    logger.warning(
+                        "Node %s marked as inactive due to missed heartbeat", node_id
+                    )
 
-            db.commit()
+                # Count active nodes with a plain COUNT(*), not a count over a
+                # subquery of every column
+                active_node_count = db.scalar(
+                    select(func.count())
+                    .select_from(StorageNode)
+                    .where(StorageNode.is_active == True)
+                )
 
-            return {
-                "active_nodes": active_node_count,
-                "min_required": self.min_required_nodes,
-                "stale_nodes": [node.node_id for node in stale_nodes],
-                "replacement_needed": active_node_count < self.min_required_nodes,
-            }
+                db.commit()
+                if stale_node_ids:
+                    self.active_nodes_cache.invalidate()
+
+                return {
+                    "active_nodes": active_node_count,
+                    "min_required": self.min_required_nodes,
+                    "stale_nodes": stale_node_ids,
+                    "replacement_needed": active_node_count < self.min_required_nodes,
+                }
 
-        except Exception as e:
-            logger.error(f"Error checking node health: {str(e)}")
-            db.rollback()
-            return {"error": str(e)}
-        finally:
-            db.close()
+            except Exception as e:
+                logger.error("Error checking node health: %s", e)
+                db.rollback()
+                return {"error": str(e)}
 
     async def update_node_heartbeat(self, node_id: str) -> bool:
         """Update the heartbeat timestamp for a node"""
-        db = next(get_db_session())
-        try:
-            node = db.query(StorageNode).filter(StorageNode.node_id == node_id).first()
-            if node:
-                node.last_heartbeat = datetime.utcnow()
-                node.is_active = True
+        with DatabaseSession() as db:
+            try:
+                # Single atomic UPDATE instead of SELECT + mutate + flush
+                result = db.execute(
+                    _HEARTBEAT_STMT,
+                    {"b_node_id": node_id, "heartbeat_at": datetime.utcnow()},
+                )
                 db.commit()
-                return True
-            return False
-        except Exception as e:
-            logger.error(f"Error updating heartbeat for node {node_id}: {str(e)}")
-            db.rollback()
-            return False
-        finally:
-            db.close()
+                # A heartbeat can revive a node the cached active set lacks
+                cached_nodes = self.active_nodes_cache.get()
+                if cached_nodes is not None and all(
+                    node["node_id"] != node_id for node in cached_nodes
+                ):
+                    self.active_nodes_cache.invalidate()
+                return result.rowcount > 0
+            except Exception as e:
+                logger.error("Error updating heartbeat for node %s: %s", node_id, e)
+                db.rollback()
+                return False
 
     async def discover_nodes(self):
         """Discover and register storage nodes"""
@@ -387,5 +485,5 @@ class NodeService:
                 await asyncio.sleep(15)  # Check every 15 seconds for faster testing
                 await self.check_node_health()
             except Exception as e:
-                logger.error(f"Error in heartbeat monitor: {str(e)}")
+                logger.error("Error in heartbeat monitor: %s", e)
                 await asyncio.sleep(30)  # Wait longer on error
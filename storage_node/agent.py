@@ -3,14 +3,17 @@ import hashlib
 import json
 import logging
 import os
+import tempfile
 import time
 from contextlib import asynccontextmanager
 from datetime import datetime
 from pathlib import Path
+from typing import AsyncIterator, Optional
 
 import httpx
+import psutil
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import Response
+from fastapi.responses import FileResponse
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -24,8 +27,6 @@ my_node_url = f"http://storage-node-{my_node_id}:{port_number}"
 try:
     data_storage_path.mkdir(parents=True, exist_ok=True)
 except (OSError, PermissionError):
-    import tempfile
-
     temp_dir = Path(tempfile.mkdtemp())
     data_storage_path = temp_dir
     print(
@@ -40,6 +41,11 @@ class StorageAgent:
         self.node_id = my_node_id
         self.node_url = my_node_url
 
+        # One keep-alive connection pool to the controller for all calls
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=2, max_keepalive_connections=2)
+        )
+
         # Metrics tracking
         self.metrics = {
             "upload_ops_count": 0,
@@ -48,28 +54,31 @@ class StorageAgent:
             "response_times": [],
         }
 
+        # The first cpu_percent() call always returns 0.0; prime it here so
+        # the first reported sample is meaningful.
+        psutil.cpu_percent(interval=None)
+
     async def register_with_controller(self):
         """Try to register ourselves with the main controller"""
         try:
-            async with httpx.AsyncClient() as http_client:
-                node_info = {
-                    "node_id": self.node_id,
-                    "url": self.node_url,
-                    "capacity": self.calculate_storage_capacity(),
-                }
-
-                resp = await http_client.post(
-                    f"{self.controller_url}/nodes/register",
-                    json=node_info,
-                    timeout=10.0,
-                )
-
-                if resp.status_code == 200:
-                    logger.info(f"Node {self.node_id} registered successfully!")
-                    return True
-                else:
-                    logger.error(f"Registration failed: {resp.status_code}")
-                    return False
+            node_info = {
+                "node_id": self.node_id,
+                "url": self.node_url,
+                "capacity": self.calculate_storage_capacity(),
+            }
+
+            resp = await self.http_client.post(
+                f"{self.controller_url}/nodes/register",
+                json=node_info,
+                timeout=10.0,
+            )
+
+            if resp.status_code == 200:
+                logger.info(f"Node {self.node_id} registered successfully!")
+                return True
+            else:
+                logger.error(f"Registration failed: {resp.status_code}")
+                return False
         except Exception as ex:
             logger.error(f"Couldn't register with controller: {str(ex)}")
             return False
@@ -77,25 +86,24 @@ class StorageAgent:
     async def send_heartbeat(self):
 
         try:
-            async with httpx.AsyncClient() as http_client:
-                heartbeat_data = {
-                    "node_id": self.node_id,
-                    "timestamp": datetime.utcnow().isoformat(),
-                    "status": "healthy",
-                }
-
-                resp = await http_client.post(
-                    f"{self.controller_url}/nodes/heartbeat",
-                    json=heartbeat_data,
-                    timeout=5.0,
-                )
-
-                if resp.status_code == 200:
-                    logger.debug(f"Heartbeat sent successfully for node {self.node_id}")
-                    return True
-                else:
-                    logger.warning(f"Heartbeat failed: {resp.status_code}")
-                    return False
+            heartbeat_data = {
+                "node_id": self.node_id,
+                "timestamp": datetime.utcnow().isoformat(),
+                "status": "healthy",
+            }
+
+            resp = await self.http_client.post(
+                f"{self.controller_url}/nodes/heartbeat",
+                json=heartbeat_data,
+                timeout=5.0,
+            )
+
+            if resp.status_code == 200:
+                logger.debug(f"Heartbeat sent successfully for node {self.node_id}")
+                return True
+            else:
+                logger.warning(f"Heartbeat failed: {resp.status_code}")
+                return False
         except Exception as ex:
             logger.warning(f"Couldn't send heartbeat: {str(ex)}")
             return False
@@ -114,39 +122,50 @@ class StorageAgent:
         except Exception:
             return 0
 
-    async def save_file_locally(self, file_id: str, file_content: bytes) -> bool:
+    async def save_file_locally(
+        self, file_id: str, chunks: AsyncIterator[bytes]
+    ) -> Optional[int]:
+        """Write an incoming stream to disk, hashing it in the same pass"""
+        target_file = self.storage_dir / file_id
+        partial_file = self.storage_dir / f"{file_id}.part"
         try:
-            target_file = self.storage_dir / file_id
-            with open(target_file, "wb") as f:
-                f.write(file_content)
+            file_hash = hashlib.sha256(usedforsecurity=False)
+            file_size = 0
+            with open(partial_file, "wb") as f:
+                async for chunk in chunks:
+                    f.write(chunk)
+                    file_hash.update(chunk)
+                    file_size += len(chunk)
+            # Only expose the file once it has been received in full
+            os.replace(partial_file, target_file)
             file_metadata = {
                 "file_id": file_id,
-                "size": len(file_content),
-                "checksum": hashlib.sha256(file_content).hexdigest(),
+                "size": file_size,
+                "checksum": file_hash.hexdigest(),
             }
             meta_file = self.storage_dir / f"{file_id}.meta"
             with open(meta_file, "w") as f:
                 json.dump(file_metadata, f)
-            logger.info(f"Saved file {file_id} - {len(file_content)} bytes")
-            return True
+            logger.info(f"Saved file {file_id} - {file_size} bytes")
+            return file_size
         except Exception as ex:
             logger.error(f"Failed to store file {file_id}: {str(ex)}")
-            return False
+            partial_file.unlink(missing_ok=True)
+            return None
 
-    async def load_file_locally(self, file_id: str) -> bytes:
-        """Load a file from our local storage"""
+    async def locate_file_locally(self, file_id: str) -> Path:
+        """Find a stored file so it can be streamed back from disk"""
         try:
             target_file = self.storage_dir / file_id
 
             if not target_file.exists():
                 raise HTTPException(status_code=404, detail="File not found")
 
-            with open(target_file, "rb") as f:
-                file_data = f.read()
-
-            logger.info(f"Loaded file {file_id} - {len(file_data)} bytes")
-            return file_data
+            logger.info(f"Serving file {file_id} - {target_file.stat().st_size} bytes")
+            return target_file
 
+        except HTTPException:
+            raise
         except Exception as ex:
             logger.error(f"Couldn't load file {file_id}: {str(ex)}")
             raise HTTPException(
@@ -200,8 +219,6 @@ class StorageAgent:
 
     def get_current_metrics(self) -> dict:
 
-        import psutil
-
         total_storage = self.calculate_storage_capacity()
         used_storage = self.calculate_used_space()
         available_storage = total_storage - used_storage
@@ -230,20 +247,20 @@ class StorageAgent:
     async def send_metrics_to_controller(self):
 
         try:
-            metrics = self.get_current_metrics()
-            async with httpx.AsyncClient() as http_client:
-                resp = await http_client.post(
-                    f"{self.controller_url}/metrics/nodes/{self.node_id}",
-                    json=metrics,
-                    timeout=10.0,
-                )
-
-                if resp.status_code == 200:
-                    logger.debug(f"Metrics sent successfully for node {self.node_id}")
-                    return True
-                else:
-                    logger.warning(f"Failed to send metrics: {resp.status_code}")
-                    return False
+            # Walking the storage dir and psutil calls are blocking syscalls
+            metrics = await asyncio.to_thread(self.get_current_metrics)
+            resp = await self.http_client.post(
+                f"{self.controller_url}/metrics/nodes/{self.node_id}",
+                json=metrics,
+                timeout=10.0,
+            )
+
+            if resp.status_code == 200:
+                logger.debug(f"Metrics sent successfully for node {self.node_id}")
+                return True
+            else:
+                logger.warning(f"Failed to send metrics: {resp.status_code}")
+                return False
         except Exception as ex:
             logger.warning(f"Couldn't send metrics: {str(ex)}")
             return False
@@ -268,18 +285,26 @@ async def lifespan(app: FastAPI):
     # Shutdown
     logger.info(f"Storage node {my_node_id} is shutting down...")
     heartbeat_task.cancel()
+    await storage_agent.http_client.aclose()
 
 
 async def heartbeat_loop():
     """Background task to send regular heartbeats and metrics"""
+    interval = 15  # seconds
+    # Schedule against a fixed cadence so the time spent sending does not
+    # push every following heartbeat later.
+    next_tick = time.monotonic()
     while True:
+        next_tick += interval
+        # Don't burst to catch up after a long stall, just resume the cadence
+        next_tick = max(next_tick, time.monotonic())
+        await asyncio.sleep(next_tick - time.monotonic())
         try:
-            await asyncio.sleep(15)  # 15 seconds
             await storage_agent.send_heartbeat()
             await storage_agent.send_metrics_to_controller()  # Send metrics with heartbeat
         except Exception as e:
             logger.error(f"Error in heartbeat loop: {str(e)}")
-            await asyncio.sleep(30)  # Wait longer on error
+            next_tick += 30  # Wait longer on error
 
 
 app = FastAPI(title="Storage Node Agent", version="1.0.0", lifespan=lifespan)
@@ -292,7 +317,7 @@ async def health_status():
         "status": "healthy",
         "node_id": my_node_id,
         "storage_path": str(data_storage_path),
-        "used_space": storage_agent.calculate_used_space(),
+        "used_space": await asyncio.to_thread(storage_agent.calculate_used_space),
         "capacity": storage_agent.calculate_storage_capacity(),
     }
 
@@ -302,13 +327,12 @@ async def store_file_endpoint(file_id: str, request: Request):
     """Endpoint to store a file on this node"""
     start_time = time.time()
     try:
-        file_content = await request.body()
-        store_success = await storage_agent.save_file_locally(file_id, file_content)
+        stored_size = await storage_agent.save_file_locally(file_id, request.stream())
 
-        if store_success:
+        if stored_size is not None:
             response_time = (time.time() - start_time) * 1000  # Convert to ms
             storage_agent.record_operation("upload", response_time)
-            return {"status": "stored", "file_id": file_id, "size": len(file_content)}
+            return {"status": "stored", "file_id": file_id, "size": stored_size}
         else:
             raise HTTPException(status_code=500, detail="Couldn't store the file")
     except Exception as ex:
@@ -321,10 +345,11 @@ async def retrieve_file_endpoint(file_id: str):
     """Endpoint to get a file from this node"""
     start_time = time.time()
     try:
-        file_content = await storage_agent.load_file_locally(file_id)
+        target_file = await storage_agent.locate_file_locally(file_id)
         response_time = (time.time() - start_time) * 1000  # Convert to ms
         storage_agent.record_operation("download", response_time)
-        return Response(content=file_content, media_type="application/octet-stream")
+        # FileResponse streams from disk in chunks instead of reading it all
+        return FileResponse(target_file, media_type="application/octet-stream")
     except HTTPException:
         raise
     except Exception as ex:
@@ -364,12 +389,13 @@ async def list_files_endpoint():
 @app.get("/stats")
 async def node_statistics():
     """Get some stats about this storage node"""
+    capacity = storage_agent.calculate_storage_capacity()
+    used_space = await asyncio.to_thread(storage_agent.calculate_used_space)
     return {
         "node_id": my_node_id,
-        "capacity": storage_agent.calculate_storage_capacity(),
-        "used_space": storage_agent.calculate_used_space(),
-        "available_space": storage_agent.calculate_storage_capacity()
-        - storage_agent.calculate_used_space(),
+        "capacity": capacity,
+        "used_space": used_space,
+        "available_space": capacity - used_space,
         "files_count": len(await storage_agent.get_file_list()),
     }
 
@@ -1,8 +1,10 @@
 import os
 import sys
+import threading
 import time
 
 import pytest
+import requests
 
 sys.path.insert(0, os.path.dirname(__file__))
 from test_helpers import E2ETestHelpers
@@ -111,6 +113,86 @@ def test_multi_file_distribution_and_load_balancing(
                 pass
 
 
+def test_large_file_replication_integrity(services, controller_client, db_cursor):
+    """
+    Test that a multi-MiB upload lands intact on every replica.
+
+    Verifies:
+    - The upload is streamed to the replicas in several chunks
+    - Each replica node holds a byte-identical copy
+    - The size and checksum recorded in the database match the content
+    """
+    helpers = E2ETestHelpers(controller_client, db_cursor)
+    test_file_path = helpers.create_binary_test_file(
+        "large_replication_test.bin", 8 * 1024 * 1024 + 123
+    )
+
+    try:
+        upload_result = helpers.upload_file(
+            test_file_path, "large_replication_test.bin"
+        )
+        file_id = upload_result["file_id"]
+        assert len(upload_result["nodes"]) >= 2, "Expected at least 2 replicas"
+
+        helpers.verify_file_locations(file_id, upload_result["nodes"])
+        helpers.verify_file_checksum_in_database(file_id, test_file_path)
+
+        for node_id in upload_result["nodes"]:
+            status_code, content = helpers.retrieve_file_from_node(node_id, file_id)
+            assert status_code == 200, f"Replica on node {node_id} missing"
+            helpers.verify_file_content_integrity(content, test_file_path)
+
+        status_code, content = helpers.retrieve_file(file_id)
+        assert status_code == 200, f"Expected 200, got {status_code}"
+        helpers.verify_file_content_integrity(content, test_file_path)
+
+        helpers.delete_file(file_id)
+        print(f"✓ Large file replicated intact to {upload_result['nodes']}")
+    finally:
+        helpers.cleanup_test_file(test_file_path)
+
+
+def test_node_metrics_history_pagination(services, controller_client, db_cursor):
+    """
+    Test keyset pagination of a node's metrics history.
+
+    Verifies:
+    - Pages come back newest first and never exceed the limit
+    - Following next_cursor visits every row exactly once
+    - The last page reports no next_cursor
+    """
+    helpers = E2ETestHelpers(controller_client, db_cursor)
+    node_id = "pagination-test-node"
+    report_count = 7
+
+    for i in range(report_count):
+        helpers.post_node_metrics(node_id, {"files_count": i})
+
+    # Metrics are buffered and flushed in the background every few seconds
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        page = helpers.get_node_metrics_page(node_id, limit=100)
+        if len(page["metrics"]) >= report_count:
+            break
+        time.sleep(1)
+    assert len(page["metrics"]) == report_count, "Metrics were not flushed"
+
+    timestamps = []
+    cursor = None
+    while True:
+        page = helpers.get_node_metrics_page(node_id, limit=3, before=cursor)
+        assert len(page["metrics"]) <= 3
+        timestamps.extend(row["timestamp"] for row in page["metrics"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+
+    assert len(timestamps) == report_count, f"Visited {len(timestamps)} rows"
+    assert timestamps == sorted(timestamps, reverse=True), "Pages not newest first"
+    assert len(set(timestamps)) == report_count, "Rows repeated across pages"
+    print(f"✓ Paginated {report_count} metrics rows in pages of 3")
+
+
 # ============================================================================
 # RESILIENCE TESTS - Test fault tolerance and recovery
 # ============================================================================
@@ -162,6 +244,79 @@ def test_node_failure_detection_and_resilience(
         helpers.cleanup_test_file(test_file_path)
 
 
+def test_upload_survives_node_failure_mid_replication(
+    services, controller_client, db_cursor, docker_compose_file
+):
+    """
+    Test an upload while one of its replica nodes dies mid-stream.
+
+    Nodes 1 and 2 are left as the only replica targets. Node 2 is frozen, so
+    it accepts the upload's connection but never reads it, and the stream
+    stalls part-way with node 1 holding a .part file. Node 2 is then killed.
+
+    Verifies:
+    - The upload completes instead of hanging on the dead replica
+    - Only node 1, which stored the whole file, is recorded
+    - Node 1's copy and the controller download are intact
+    """
+    helpers = E2ETestHelpers(controller_client, db_cursor)
+    node_ids = {node["node_id"] for node in helpers.get_nodes()}
+    if not {"1", "2"} <= node_ids:
+        pytest.skip("Need storage nodes 1 and 2 for failure testing")
+    spare_node_ids = sorted(node_ids - {"1", "2"})
+
+    filename = "node_failure_upload.bin"
+    test_file_path = helpers.create_binary_test_file(filename, 64 * 1024 * 1024)
+    upload = {}
+
+    def run_upload():
+        upload["response"] = helpers.post_file(test_file_path, filename)
+
+    uploader = threading.Thread(target=run_upload)
+    try:
+        for node_id in spare_node_ids:
+            helpers.stop_node(f"storage-node-{node_id}", docker_compose_file)
+            helpers.wait_for_node_inactive(node_id)
+
+        helpers.pause_node("storage-node-2", docker_compose_file)
+        uploader.start()
+        assert helpers.wait_for_partial_upload(
+            "storage-node-1", docker_compose_file
+        ), "Upload never started streaming to node 1"
+        helpers.kill_node("storage-node-2", docker_compose_file)
+
+        uploader.join(timeout=180)
+        assert not uploader.is_alive(), "Upload hung after a replica went down"
+
+        response = upload["response"]
+        assert response.status_code == 200, f"Upload failed: {response.text}"
+        upload_result = response.json()
+        file_id = upload_result["file_id"]
+        assert upload_result["nodes"] == ["1"], f"Got {upload_result['nodes']}"
+
+        helpers.verify_file_locations(file_id, ["1"])
+        helpers.verify_file_checksum_in_database(file_id, test_file_path)
+
+        status_code, content = helpers.retrieve_file_from_node("1", file_id)
+        assert status_code == 200, "Replica on node 1 missing"
+        helpers.verify_file_content_integrity(content, test_file_path)
+
+        status_code, content = helpers.retrieve_file(file_id)
+        assert status_code == 200, "File should be readable from node 1"
+        helpers.verify_file_content_integrity(content, test_file_path)
+
+        helpers.delete_file(file_id)
+        print("✓ Upload completed on node 1 after node 2 died mid-stream")
+    finally:
+        if uploader.is_alive():
+            uploader.join(timeout=60)
+        helpers.resume_node("storage-node-2", docker_compose_file)
+        for node_id in spare_node_ids:
+            helpers.start_node(f"storage-node-{node_id}", docker_compose_file)
+        time.sleep(10)
+        helpers.cleanup_test_file(test_file_path)
+
+
 def test_orchestration_health_monitoring(services, controller_client, db_cursor):
     """
     Test health monitoring and node status reporting.
@@ -266,6 +421,51 @@ def test_end_to_end_workflow_integration(
                 helpers.cleanup_test_file(file_info["path"])
 
 
+# ============================================================================
+# DATABASE OUTAGE TEST - Runs last: restarting Postgres drops the session's
+# db_connection, so no test after this one may use db_cursor
+# ============================================================================
+
+
+def test_metrics_buffered_through_database_outage(
+    services, controller_client, docker_compose_file
+):
+    """
+    Test that node metrics reported while the database is down are not lost.
+
+    Verifies:
+    - Metrics posts keep succeeding while Postgres is unreachable
+    - Failed flushes keep the rows buffered instead of dropping them
+    - The buffered rows are written once the database is back
+    """
+    helpers = E2ETestHelpers(controller_client, None)
+    node_id = "outage-test-node"
+    report_count = 3
+
+    helpers.stop_node("db", docker_compose_file)
+    try:
+        for i in range(report_count):
+            helpers.post_node_metrics(node_id, {"files_count": i})
+        # Let several background flushes fail against the stopped database
+        time.sleep(10)
+    finally:
+        helpers.start_node("db", docker_compose_file)
+
+    rows = []
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            rows = helpers.get_node_metrics_page(node_id, limit=100)["metrics"]
+        except (AssertionError, requests.RequestException):
+            rows = []
+        if len(rows) >= report_count:
+            break
+        time.sleep(2)
+
+    assert len(rows) == report_count, f"Expected {report_count} rows, got {len(rows)}"
+    print(f"✓ {report_count} metrics rows survived the database outage")
+
+
 # ============================================================================
 # KUBERNETES-SPECIFIC TESTS (to be added later)
 # ============================================================================
@@ -1,3 +1,4 @@
+import hashlib
 import os
 import subprocess
 import time
@@ -21,17 +22,25 @@ class E2ETestHelpers:
             f.write(content)
         return test_file_path
 
+    def create_binary_test_file(self, filename: str, size_bytes: int) -> str:
+        test_file_path = os.path.join(os.path.dirname(__file__), filename)
+        with open(test_file_path, "wb") as f:
+            f.write(os.urandom(size_bytes))
+        return test_file_path
+
     def cleanup_test_file(self, file_path: str):
         if os.path.exists(file_path):
             os.remove(file_path)
 
-    def upload_file(self, file_path: str, filename: str) -> Dict:
+    def post_file(self, file_path: str, filename: str) -> requests.Response:
         with open(file_path, "rb") as f:
             files = {"uploaded_file": (filename, f, "text/plain")}
-            response = self.controller_client.post(
-                f"{self.base_url}/files/upload", files=files
+            return self.controller_client.post(
+                f"{self.base_url}/files/upload", files=files, timeout=120
             )
 
+    def upload_file(self, file_path: str, filename: str) -> Dict:
+        response = self.post_file(file_path, filename)
         assert response.status_code == 200, f"Upload failed: {response.text}"
         return response.json()
 
@@ -45,6 +54,14 @@ class E2ETestHelpers:
             print(f"Error retrieving file {file_id}: {e}")
             return 500, b""
 
+    def retrieve_file_from_node(self, node_id: str, file_id: str) -> Tuple[int, bytes]:
+        node_port = os.getenv(f"STORAGE_NODE_{node_id}_PORT")
+        assert node_port, f"No STORAGE_NODE_{node_id}_PORT set for node {node_id}"
+        response = requests.get(
+            f"http://localhost:{node_port}/retrieve/{file_id}", timeout=30
+        )
+        return response.status_code, response.content
+
     def delete_file(self, file_id: str) -> Dict:
         response = self.controller_client.delete(f"{self.base_url}/files/{file_id}")
         assert response.status_code == 200, f"Delete failed: {response.text}"
@@ -93,6 +110,36 @@ class E2ETestHelpers:
             expected_nodes
         ), f"Database nodes {db_nodes} don't match expected {expected_nodes}"
 
+    def verify_file_checksum_in_database(self, file_id: str, expected_file_path: str):
+        with open(expected_file_path, "rb") as f:
+            expected_content = f.read()
+        self.db_cursor.execute(
+            "SELECT size, checksum FROM files WHERE file_id = %s", (file_id,)
+        )
+        size, checksum = self.db_cursor.fetchone()
+        assert size == len(expected_content), f"Size mismatch in database: {size}"
+        assert (
+            checksum == hashlib.sha256(expected_content).hexdigest()
+        ), "Checksum mismatch in database"
+
+    def post_node_metrics(self, node_id: str, metrics: Dict):
+        response = self.controller_client.post(
+            f"{self.base_url}/metrics/nodes/{node_id}", json=metrics
+        )
+        assert response.status_code == 200, f"Metrics post failed: {response.text}"
+
+    def get_node_metrics_page(
+        self, node_id: str, limit: int, before: str = None
+    ) -> Dict:
+        params = {"limit": limit}
+        if before is not None:
+            params["before"] = before
+        response = self.controller_client.get(
+            f"{self.base_url}/metrics/nodes/{node_id}", params=params
+        )
+        assert response.status_code == 200, f"Metrics fetch failed: {response.text}"
+        return response.json()
+
     def verify_file_content_integrity(
         self, downloaded_content: bytes, expected_file_path: str
     ):
@@ -118,6 +165,64 @@ class E2ETestHelpers:
         )
         assert result.returncode == 0, f"Failed to start {node_name}: {result.stderr}"
 
+    def pause_node(self, node_name: str, docker_compose_file: str):
+        result = subprocess.run(
+            ["docker-compose", "-f", docker_compose_file, "pause", node_name],
+            capture_output=True,
+            text=True,
+        )
+        assert result.returncode == 0, f"Failed to pause {node_name}: {result.stderr}"
+
+    def kill_node(self, node_name: str, docker_compose_file: str):
+        result = subprocess.run(
+            ["docker-compose", "-f", docker_compose_file, "kill", node_name],
+            capture_output=True,
+            text=True,
+        )
+        assert result.returncode == 0, f"Failed to kill {node_name}: {result.stderr}"
+
+    def resume_node(self, node_name: str, docker_compose_file: str):
+        # The node may or may not still be paused; only the restart must work
+        subprocess.run(
+            ["docker-compose", "-f", docker_compose_file, "unpause", node_name],
+            capture_output=True,
+            text=True,
+        )
+        self.start_node(node_name, docker_compose_file)
+
+    def wait_for_partial_upload(
+        self, node_name: str, docker_compose_file: str, timeout: int = 30
+    ) -> bool:
+        start_time = time.time()
+        while time.time() - start_time < timeout:
+            result = subprocess.run(
+                [
+                    "docker-compose",
+                    "-f",
+                    docker_compose_file,
+                    "exec",
+                    "-T",
+                    node_name,
+                    "sh",
+                    "-c",
+                    "ls /data/*.part",
+                ],
+                capture_output=True,
+                text=True,
+            )
+            if result.returncode == 0:
+                return True
+            time.sleep(0.5)
+        return False
+
+    def wait_for_node_inactive(self, node_id: str, timeout: int = 90):
+        start_time = time.time()
+        while time.time() - start_time < timeout:
+            if node_id not in {node["node_id"] for node in self.get_nodes()}:
+                return
+            time.sleep(3)
+        raise AssertionError(f"Node {node_id} still active after {timeout}s")
+
     def verify_controller_health(self):
         response = self.controller_client.get(f"{self.base_url}/health")
         assert response.status_code == 200, "Controller health check failed"